@@ -1,17 +1,28 @@
 import os
 import time
 import uuid
-from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, url_for, session
+from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, url_for, session, g
 from flask_cors import CORS
 import openai
 import base64
 import json
-import numpy as np
 from dotenv import load_dotenv
 import ssl
 from pathlib import Path
 import threading
 import queue
+import sys
+import hmac
+import random
+import tracemalloc
+import inspect
+import hashlib
+import tempfile
+import unicodedata
+import requests
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
@@ -32,6 +43,29 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 openai.api_key = os.getenv("DASHSCOPE_API_KEY") or "sk-xxx"  # Replace with your API key if not using env var
 openai.api_base = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 
+# 上游连接池配置
+UPSTREAM_POOL_SIZE = 8  # 连接池大小
+UPSTREAM_WARM_CONNECTIONS = 2  # 启动时预先建立的连接数
+UPSTREAM_KEEPALIVE = 45  # 空闲连接保活间隔（秒）
+CANNED_RETRY_MAX = 30 * 60  # 固定回复渲染失败后重试的最长间隔（秒）
+
+class UpstreamSession(requests.Session):
+    """所有线程共享的上游会话
+
+    openai 每隔几分钟会关闭线程内的会话，共享会话忽略关闭以保留预热好的连接。
+    """
+    
+    def close(self):
+        pass
+
+upstream_session = UpstreamSession()
+upstream_session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=UPSTREAM_POOL_SIZE,
+    max_retries=2
+))
+openai.requestssession = upstream_session
+
 # 活跃通话会话管理
 active_calls = {}
 interrupt_flags = {}
@@ -39,6 +73,159 @@ interrupt_flags = {}
 # 会话超时时间（分钟）
 SESSION_TIMEOUT = 10
 
+# 固定回复，启动时预渲染为音频以便直接下发
+CALL_GREETING = '通话已开始，请开始对话'
+EMPTY_INPUT_REPLY = '请说些什么，我在听。'
+CANNED_MODEL = "qwen-omni-turbo-0119"
+CANNED_VOICE = "Cherry"
+CANNED_AUDIO_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads', 'canned')
+# 内置短语始终预渲染；环境变量 CANNED_PHRASES 可追加更多短语（用 | 分隔），
+# 追加的短语通过 /api/voice-chat/canned 下发
+CANNED_PHRASES = [CALL_GREETING, EMPTY_INPUT_REPLY]
+for _phrase in os.getenv("CANNED_PHRASES", "").split('|'):
+    if _phrase.strip() and _phrase.strip() not in CANNED_PHRASES:
+        CANNED_PHRASES.append(_phrase.strip())
+canned_audio = {}  # 短语 -> base64音频片段列表
+
+# 预热状态
+warmup_state = {
+    'ready': False,
+    'started_at': None,
+    'finished_at': None,
+    'steps': {},
+}
+
+# 性能剖析配置（仅管理员可用，未设置 ADMIN_TOKEN 时剖析接口全部禁用）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_DURATION = 600  # 单次剖析最长时间（秒）
+PROFILE_TOP_ALLOCATIONS = 30  # 返回的内存分配热点数量
+PROFILE_TRACE_FRAMES = 32  # tracemalloc 保存的调用帧数，需足够深才能找到所属的视图函数
+
+# 剖析状态，由 profiler_lock 保护
+profiler_lock = threading.Lock()
+profiler_state = {
+    'active': False,
+    'mode': None,  # 'duration' 采样全部线程, 'requests' 只采样按比例选中的请求
+    'started_at': None,
+    'ends_at': None,
+    'interval': 0.005,
+    'sample_rate': 100.0,  # 请求采样百分比
+    'track_allocations': False,
+    'samples': 0,
+    'generation': 0,  # 每次开启剖析加一，旧的采样线程据此退出
+}
+profile_stacks = {}  # 折叠栈 -> 采样次数
+profile_request_counts = {}  # 端点 -> 被采样的请求数
+profile_allocation_report = {}  # 结束剖析时保存的内存分配报告
+profile_sampler_thread = None
+profiled_threads = {}  # 线程ID -> 正在处理的端点
+
+# 可续传SSE配置：每次回复的事件保存在有上限的缓冲区中，断线后可凭 Last-Event-ID 续传
+REPLAY_BUFFER_MAX_BYTES = 8 * 1024 * 1024  # 单次回复缓冲区上限（字节）
+REPLAY_TTL = 60  # 回复结束后缓冲区保留时间（秒）
+REPLAY_KEEPALIVE = 15  # 等待新事件时发送心跳的间隔（秒）
+
+class ReplyBuffer:
+    """单次AI回复的SSE事件环形缓冲区
+
+    上游生成线程通过 append 写入事件，任意数量的客户端连接通过 iter_events
+    从指定序号之后读取，超过内存上限时丢弃最早的事件。
+    """
+    
+    def __init__(self, reply_id, session_id, max_bytes=REPLAY_BUFFER_MAX_BYTES):
+        self.reply_id = reply_id
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        self.events = deque()  # (序号, 已编码的SSE事件)
+        self.size = 0
+        self.next_seq = 0
+        self.done = False
+        self.cancelled = False  # 通话结束或会话过期时置位，生成线程据此停止上游请求
+        self.finished_at = None
+        self.cond = threading.Condition()
+    
+    def append(self, payload):
+        """编码并追加一个事件，返回事件序号"""
+        data = json.dumps(payload)
+        with self.cond:
+            seq = self.next_seq
+            self.next_seq += 1
+            event = f"id: {self.reply_id}:{seq}\ndata: {data}\n\n"
+            self.events.append((seq, event))
+            self.size += len(event)
+            # 超出上限时丢弃最旧的事件，至少保留最新一个
+            while self.size > self.max_bytes and len(self.events) > 1:
+                _, dropped = self.events.popleft()
+                self.size -= len(dropped)
+            self.cond.notify_all()
+        return seq
+    
+    def close(self):
+        """标记回复结束，唤醒所有等待中的读取者"""
+        with self.cond:
+            self.done = True
+            self.finished_at = time.time()
+            self.cond.notify_all()
+    
+    def cancel(self):
+        """取消回复：生成线程在下一个上游数据块时停止"""
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+    
+    def can_resume(self, last_seq):
+        """序号 last_seq 之后的事件是否仍全部保存在缓冲区中"""
+        with self.cond:
+            first_seq = self.events[0][0] if self.events else self.next_seq
+            return first_seq <= last_seq + 1 <= self.next_seq
+    
+    def iter_events(self, last_seq=-1):
+        """依次产出 last_seq 之后的事件，直到回复结束"""
+        while True:
+            with self.cond:
+                first_seq = self.events[0][0] if self.events else self.next_seq
+                if first_seq > last_seq + 1:
+                    # 读取速度跟不上，所需事件已被丢弃
+                    gap = True
+                else:
+                    gap = False
+                    # 序号连续，可直接算出待发送的事件数；读取者通常在末尾附近，
+                    # 从右端取出，每次唤醒只处理新事件，而不是扫描整个缓冲区
+                    pending = list(islice(reversed(self.events), self.next_seq - (last_seq + 1)))
+                    pending.reverse()
+                    if not pending:
+                        if self.done:
+                            return
+                        if not self.cond.wait(timeout=REPLAY_KEEPALIVE):
+                            pending = None
+            
+            if gap:
+                yield f"data: {json.dumps({'type': 'error', 'content': '回复缓冲区已溢出，无法继续续传'})}\n\n"
+                return
+            if pending is None:
+                # SSE注释行，保持移动网络下的连接
+                yield ": keepalive\n\n"
+                continue
+            for seq, event in pending:
+                yield event
+                last_seq = seq
+
+# 回复ID -> ReplyBuffer
+reply_buffers = {}
+reply_buffers_lock = threading.Lock()
+
+def drop_reply_buffers(session_id=None, expired_before=None):
+    """删除指定会话的缓冲区，或结束时间早于 expired_before 的缓冲区"""
+    with reply_buffers_lock:
+        for reply_id, buffer in list(reply_buffers.items()):
+            if session_id is not None and buffer.session_id == session_id:
+                reply_buffers.pop(reply_id, None)
+                buffer.cancel()
+            elif (expired_before is not None and buffer.finished_at is not None
+                  and buffer.finished_at < expired_before):
+                reply_buffers.pop(reply_id, None)
+                buffer.cancel()
+
 @app.route('/')
 def index():
     return send_from_directory('static', 'index.html')
@@ -63,7 +250,9 @@ def start_call():
     return jsonify({
         'session_id': session_id,
         'status': 'started',
-        'message': '通话已开始，请开始对话'
+        'message': CALL_GREETING,
+        # 预渲染的问候语音频（base64片段），尚未渲染完成时为空
+        'message_audio': canned_audio.get(CALL_GREETING, [])
     })
 
 @app.route('/api/call/end', methods=['POST'])
@@ -76,6 +265,7 @@ def end_call():
         # 清理相关资源
         active_calls.pop(session_id, None)
         interrupt_flags.pop(session_id, None)
+        drop_reply_buffers(session_id=session_id)
         
         return jsonify({
             'status': 'ended',
@@ -293,9 +483,134 @@ def voice_chat():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def produce_stream_reply(session_id, messages, conversation_history, buffer, profile_endpoint=None):
+    """在后台线程中消费上游流式响应并写入回复缓冲区
+
+    与HTTP连接解耦，客户端断线后回复仍会完成并写入对话历史，重连时可从缓冲区续传。
+    """
+    if profile_endpoint:
+        with profiler_lock:
+            profiled_threads[threading.get_ident()] = profile_endpoint
+    response = None
+    try:
+        # 标记AI正在说话
+        if session_id in active_calls:
+            active_calls[session_id]['is_speaking'] = True
+        
+        # 使用 v0.28.0 API 结构与 Qwen-Omni 特定参数
+        print("\n发送到API的消息结构(已省略Base64数据):", 
+              json.dumps([{"role": m.get("role"), 
+                          "content_type": "array" if isinstance(m.get("content"), list) else "text"} 
+                         for m in messages], ensure_ascii=False))
+        
+        # 如果没有消息，返回默认回复
+        if not messages:
+            stream_canned_reply(buffer, EMPTY_INPUT_REPLY)
+            return
+        
+        # 调用API
+        response = openai.ChatCompletion.create(
+            model="qwen-omni-turbo-0119",
+            messages=messages,
+            stream=True,
+            # 配置 Qwen API 特定参数
+            modalities=["text", "audio"],
+            audio={"voice": "Cherry", "format": "wav"},
+            # 添加流选项以包含 usage 信息
+            stream_options={"include_usage": True}
+        )
+        
+        collected_response = {"role": "assistant", "content": "", "audio_parts": []}
+        
+        for chunk in response:
+            # 通话已结束或会话已过期，不再继续消耗上游生成
+            if buffer.cancelled or session_id not in active_calls:
+                print(f"通话已结束，停止生成回复 (会话: {session_id})")
+                break
+            
+            # 检查打断标志
+            if interrupt_flags.get(session_id, False):
+                print(f"检测到用户打断，结束AI回复流 (会话: {session_id})")
+                buffer.append({'type': 'interrupted', 'content': '用户打断了回复'})
+                break
+            
+            # 检查特殊情况：完成通知或结束标记
+            if 'choices' not in chunk:
+                continue
+            
+            # 确保choices列表不为空再访问
+            if not chunk['choices'] or len(chunk['choices']) == 0:
+                continue
+                
+            # 安全地获取choice
+            choice = chunk['choices'][0]
+            
+            # 处理文本内容
+            if 'delta' in choice and 'content' in choice['delta'] and choice['delta']['content']:
+                text_content = choice['delta']['content']
+                collected_response["content"] += text_content
+                buffer.append({'type': 'text', 'content': text_content})
+            
+            # 处理音频数据
+            if 'delta' in choice and 'audio' in choice['delta']:
+                try:
+                    # 尝试获取音频数据
+                    if 'data' in choice['delta']['audio']:
+                        audio_data = choice['delta']['audio']['data']
+                        collected_response["audio_parts"].append(audio_data)
+                        buffer.append({'type': 'audio', 'content': audio_data})
+                    # 尝试获取转录文本
+                    elif 'transcript' in choice['delta']['audio']:
+                        transcript = choice['delta']['audio']['transcript']
+                        buffer.append({'type': 'transcript', 'content': transcript})
+                except Exception as e:
+                    print(f"处理音频响应时出错: {e}")
+                    continue
+                    
+            # 检查是否是最后一个消息
+            if choice.get('finish_reason') is not None:
+                print("流式响应完成，原因:", choice.get('finish_reason'))
+                # 简化音频部分数据存储，避免消息过大
+                if collected_response.get("audio_parts", []):
+                    collected_response["has_audio"] = True
+                    collected_response.pop("audio_parts", None)
+                # 添加到对话历史
+                conversation_history.append(collected_response)
+    
+    except Exception as e:
+        print(f"生成响应时发生错误: {e}")
+        import traceback
+        traceback.print_exc()
+        buffer.append({'type': 'error', 'content': str(e)})
+    finally:
+        # 提前退出时关闭上游流；openai 返回的是生成器链，关闭后底层HTTP连接随之释放
+        if response is not None and hasattr(response, 'close'):
+            response.close()
+        # 无论如何标记AI已停止说话
+        if session_id in active_calls:
+            active_calls[session_id]['is_speaking'] = False
+        # 重置打断标志
+        if session_id in interrupt_flags:
+            interrupt_flags[session_id] = False
+        buffer.close()
+        if profile_endpoint:
+            with profiler_lock:
+                profiled_threads.pop(threading.get_ident(), None)
+
+def parse_last_event_id(value):
+    """解析 '回复ID:序号' 格式的事件ID，格式错误时返回 (None, None)"""
+    reply_id, sep, seq = (value or '').strip().rpartition(':')
+    if not sep or not reply_id or not seq.isdigit():
+        return None, None
+    return reply_id, int(seq)
+
 @app.route('/api/voice-chat/stream', methods=['POST'])
 def voice_chat_stream():
-    """获取语音通话响应流"""
+    """获取语音通话响应流
+
+    每个事件带有 'id: 回复ID:序号'。断线后携带 Last-Event-ID 请求头（或请求体中的
+    last_event_id）重新请求即可从缓冲区续传，不会再次调用模型。
+    """
     try:
         data = request.get_json()
         session_id = data.get('session_id')
@@ -303,106 +618,42 @@ def voice_chat_stream():
         # 验证会话
         if not session_id or session_id not in active_calls:
             return jsonify({"error": "无效的会话ID"}), 400
-            
-        # 从会话历史中获取消息
-        conversation_history = active_calls[session_id]['messages']
-        
-        # 准备发送给API的完整历史消息
-        messages = conversation_history.copy()
         
-        def generate():
-            try:
-                # 标记AI正在说话
-                active_calls[session_id]['is_speaking'] = True
-                
-                # 使用 v0.28.0 API 结构与 Qwen-Omni 特定参数
-                print("\n发送到API的消息结构(已省略Base64数据):", 
-                      json.dumps([{"role": m.get("role"), 
-                                  "content_type": "array" if isinstance(m.get("content"), list) else "text"} 
-                                 for m in messages], ensure_ascii=False))
-                
-                # 如果没有消息，返回默认回复
-                if not messages:
-                    yield f"data: {json.dumps({'type': 'text', 'content': '请说些什么，我在听。'})}\n\n"
-                    return
-                
-                # 调用API
-                response = openai.ChatCompletion.create(
-                    model="qwen-omni-turbo-0119",
-                    messages=messages,
-                    stream=True,
-                    # 配置 Qwen API 特定参数
-                    modalities=["text", "audio"],
-                    audio={"voice": "Cherry", "format": "wav"},
-                    # 添加流选项以包含 usage 信息
-                    stream_options={"include_usage": True}
-                )
-                
-                collected_response = {"role": "assistant", "content": "", "audio_parts": []}
-                
-                for chunk in response:
-                    # 检查打断标志
-                    if interrupt_flags.get(session_id, False):
-                        print(f"检测到用户打断，结束AI回复流 (会话: {session_id})")
-                        yield f"data: {json.dumps({'type': 'interrupted', 'content': '用户打断了回复'})}\n\n"
-                        break
-                    
-                    # 检查特殊情况：完成通知或结束标记
-                    if 'choices' not in chunk:
-                        continue
-                    
-                    # 确保choices列表不为空再访问
-                    if not chunk['choices'] or len(chunk['choices']) == 0:
-                        continue
-                        
-                    # 安全地获取choice
-                    choice = chunk['choices'][0]
-                    
-                    # 处理文本内容
-                    if 'delta' in choice and 'content' in choice['delta'] and choice['delta']['content']:
-                        text_content = choice['delta']['content']
-                        collected_response["content"] += text_content
-                        yield f"data: {json.dumps({'type': 'text', 'content': text_content})}\n\n"
-                    
-                    # 处理音频数据
-                    if 'delta' in choice and 'audio' in choice['delta']:
-                        try:
-                            # 尝试获取音频数据
-                            if 'data' in choice['delta']['audio']:
-                                audio_data = choice['delta']['audio']['data']
-                                collected_response["audio_parts"].append(audio_data)
-                                yield f"data: {json.dumps({'type': 'audio', 'content': audio_data})}\n\n"
-                            # 尝试获取转录文本
-                            elif 'transcript' in choice['delta']['audio']:
-                                transcript = choice['delta']['audio']['transcript']
-                                yield f"data: {json.dumps({'type': 'transcript', 'content': transcript})}\n\n"
-                        except Exception as e:
-                            print(f"处理音频响应时出错: {e}")
-                            continue
-                            
-                    # 检查是否是最后一个消息
-                    if choice.get('finish_reason') is not None:
-                        print("流式响应完成，原因:", choice.get('finish_reason'))
-                        # 简化音频部分数据存储，避免消息过大
-                        if collected_response.get("audio_parts", []):
-                            collected_response["has_audio"] = True
-                            collected_response.pop("audio_parts", None)
-                        # 添加到对话历史
-                        conversation_history.append(collected_response)
+        last_event_id = request.headers.get('Last-Event-ID') or data.get('last_event_id')
+        if last_event_id:
+            # 断线续传：从缓冲区读取或重新接入仍在进行的回复
+            reply_id, last_seq = parse_last_event_id(last_event_id)
+            with reply_buffers_lock:
+                buffer = reply_buffers.get(reply_id)
+            if buffer is None or buffer.session_id != session_id:
+                return jsonify({"error": "回复已过期或不存在，无法续传"}), 410
+            if not buffer.can_resume(last_seq):
+                return jsonify({"error": "所需事件已不在缓冲区中，无法续传"}), 410
+            print(f"续传回复 {reply_id}，从序号 {last_seq + 1} 开始 (会话: {session_id})")
+        else:
+            # 从会话历史中获取消息
+            conversation_history = active_calls[session_id]['messages']
             
-            except Exception as e:
-                print(f"生成响应时发生错误: {e}")
-                import traceback
-                traceback.print_exc()
-                yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
-            finally:
-                # 无论如何标记AI已停止说话
-                if session_id in active_calls:
-                    active_calls[session_id]['is_speaking'] = False
-                # 重置打断标志
-                interrupt_flags[session_id] = False
-                
-        return Response(stream_with_context(generate()), content_type='text/event-stream')
+            # 准备发送给API的完整历史消息
+            messages = conversation_history.copy()
+            
+            buffer = ReplyBuffer(str(uuid.uuid4()), session_id)
+            last_seq = -1
+            with reply_buffers_lock:
+                reply_buffers[buffer.reply_id] = buffer
+            
+            threading.Thread(
+                target=produce_stream_reply,
+                args=(session_id, messages, conversation_history, buffer, g.get('profile_endpoint')),
+                name=f"reply-{buffer.reply_id}",
+                daemon=True
+            ).start()
+        
+        return Response(
+            stream_with_context(buffer.iter_events(last_seq)),
+            content_type='text/event-stream',
+            headers={'X-Reply-Id': buffer.reply_id}
+        )
         
     except Exception as e:
         print(f"流式响应发生错误: {e}")
@@ -412,7 +663,7 @@ def voice_chat_stream():
 
 # 定期清理过期会话
 def cleanup_sessions():
-    """清理超过超时时间的会话"""
+    """清理超过超时时间的会话和过期的回复缓冲区"""
     while True:
         current_time = time.time()
         expired_sessions = []
@@ -425,6 +676,10 @@ def cleanup_sessions():
             print(f"清理过期会话: {session_id}")
             active_calls.pop(session_id, None)
             interrupt_flags.pop(session_id, None)
+            drop_reply_buffers(session_id=session_id)
+        
+        # 清理已结束且超过保留时间的回复缓冲区
+        drop_reply_buffers(expired_before=current_time - REPLAY_TTL)
         
         time.sleep(60)  # 每分钟检查一次
 
@@ -432,6 +687,214 @@ def cleanup_sessions():
 cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
 cleanup_thread.start()
 
+# ---------------- 启动预热 ----------------
+
+def canned_audio_path(text):
+    """预渲染音频的缓存文件路径，按模型、音色和文本区分"""
+    key = hashlib.sha1(f"{CANNED_MODEL}:{CANNED_VOICE}:{text}".encode('utf-8')).hexdigest()
+    return os.path.join(CANNED_AUDIO_FOLDER, f"{key}.json")
+
+def normalize_phrase(text):
+    """去掉空白和标点后比较，模型转录常会增减句末标点"""
+    return ''.join(ch for ch in text
+                   if not ch.isspace() and not unicodedata.category(ch).startswith('P'))
+
+def render_canned_audio(text):
+    """调用模型朗读固定短语，返回与流式回复相同格式的base64音频片段
+
+    模型的转录与原文不一致时（改写或多说了话）抛出 ValueError，避免缓存与文字不符的音频。
+    """
+    response = openai.ChatCompletion.create(
+        model=CANNED_MODEL,
+        messages=[{"role": "user", "content": f"请原样朗读下面这句话，不要添加任何其他内容：{text}"}],
+        stream=True,
+        modalities=["text", "audio"],
+        audio={"voice": CANNED_VOICE, "format": "wav"}
+    )
+    
+    chunks = []
+    transcript = ""
+    for chunk in response:
+        if not chunk.get('choices'):
+            continue
+        delta = chunk['choices'][0].get('delta', {})
+        if 'audio' not in delta:
+            continue
+        if 'data' in delta['audio']:
+            chunks.append(delta['audio']['data'])
+        elif 'transcript' in delta['audio']:
+            transcript += delta['audio']['transcript']
+    
+    if normalize_phrase(transcript) != normalize_phrase(text):
+        raise ValueError(f"模型朗读内容与原文不一致: '{transcript}'")
+    if not chunks:
+        raise ValueError("模型没有返回音频")
+    return chunks
+
+def save_canned_audio(path, text, chunks):
+    """写入缓存文件，使用唯一的临时文件再原子替换，避免多个进程互相覆盖"""
+    fd, tmp_path = tempfile.mkstemp(dir=CANNED_AUDIO_FOLDER, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'text': text, 'model': CANNED_MODEL, 'voice': CANNED_VOICE, 'chunks': chunks},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def prepare_canned_phrases():
+    """加载或渲染尚未就绪的固定短语音频，已渲染的直接从磁盘读取"""
+    os.makedirs(CANNED_AUDIO_FOLDER, exist_ok=True)
+    failed = []
+    for text in CANNED_PHRASES:
+        if text in canned_audio:
+            continue
+        path = canned_audio_path(text)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    canned_audio[text] = json.load(f)['chunks']
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                print(f"固定回复缓存损坏，重新渲染 '{text}': {e}")
+        
+        try:
+            chunks = render_canned_audio(text)
+        except Exception as e:
+            print(f"预渲染固定回复失败 '{text}': {e}")
+            failed.append(text)
+            continue
+        
+        # 先放入内存，写缓存失败也不影响本次运行使用
+        canned_audio[text] = chunks
+        try:
+            save_canned_audio(path, text, chunks)
+        except OSError as e:
+            print(f"保存固定回复缓存失败 '{text}': {e}")
+        print(f"已预渲染固定回复: {text}")
+    
+    if failed:
+        raise RuntimeError(f"{len(failed)} 条固定回复未能渲染: {', '.join(failed)}")
+
+def stream_canned_reply(buffer, text):
+    """下发固定回复，有预渲染音频时一并发送"""
+    buffer.append({'type': 'text', 'content': text})
+    for audio_data in canned_audio.get(text, []):
+        buffer.append({'type': 'audio', 'content': audio_data})
+
+def warm_upstream_connections():
+    """并发请求上游，完成DNS解析和TLS握手并把连接留在连接池中"""
+    url = openai.api_base.rstrip('/') + '/models'
+    
+    def ping(_):
+        response = upstream_session.get(
+            url,
+            headers={'Authorization': f"Bearer {openai.api_key}"},
+            timeout=10
+        )
+        # 读完响应体，连接才会归还到连接池
+        response.content
+        return response.status_code
+    
+    with ThreadPoolExecutor(max_workers=UPSTREAM_WARM_CONNECTIONS) as executor:
+        list(executor.map(ping, range(UPSTREAM_WARM_CONNECTIONS)))
+
+def run_warmup_step(name, step):
+    """执行一个预热步骤并记录结果，返回是否成功"""
+    step_start = time.time()
+    try:
+        step()
+        warmup_state['steps'][name] = {'ok': True}
+    except Exception as e:
+        print(f"预热步骤 {name} 失败: {e}")
+        warmup_state['steps'][name] = {'ok': False, 'error': str(e)}
+    warmup_state['steps'][name]['seconds'] = round(time.time() - step_start, 3)
+    warmup_state['steps'][name]['at'] = time.time()
+    return warmup_state['steps'][name]['ok']
+
+def run_warmup():
+    """启动预热：建立上游连接、预渲染固定回复，完成后定期保活并重试失败的步骤"""
+    warmup_state['started_at'] = time.time()
+    run_warmup_step('upstream', warm_upstream_connections)
+    canned_ok = run_warmup_step('canned', prepare_canned_phrases)
+    
+    warmup_state['finished_at'] = time.time()
+    warmup_state['ready'] = True
+    print(f"预热完成，耗时 {warmup_state['finished_at'] - warmup_state['started_at']:.2f} 秒")
+    
+    # 渲染失败的短语按指数退避重试，避免一次临时故障让它整个进程都没有音频
+    canned_retry_delay = UPSTREAM_KEEPALIVE
+    canned_retry_at = time.time() + canned_retry_delay
+    
+    # 定期访问上游，避免空闲连接被服务端断开
+    while True:
+        time.sleep(UPSTREAM_KEEPALIVE)
+        run_warmup_step('upstream', warm_upstream_connections)
+        
+        if not canned_ok and time.time() >= canned_retry_at:
+            canned_ok = run_warmup_step('canned', prepare_canned_phrases)
+            if not canned_ok:
+                canned_retry_delay = min(canned_retry_delay * 2, CANNED_RETRY_MAX)
+                print(f"固定回复将在 {canned_retry_delay} 秒后重试")
+            canned_retry_at = time.time() + canned_retry_delay
+
+# 启动预热线程。直接运行 app.py 时 debug 模式会启用 Werkzeug 重载器，
+# 父进程只负责监视文件、不处理请求，只在实际服务的子进程中预热
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    warmup_thread = threading.Thread(target=run_warmup, name='warmup', daemon=True)
+    warmup_thread.start()
+
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """就绪检查：预热完成且所有步骤都成功时返回 200
+
+    预热已结束但有步骤失败（上游不可达、固定回复未渲染）时 degraded 为 true，
+    同样返回 503；失败的步骤会在后台继续重试。
+    """
+    degraded = any(not step['ok'] for step in warmup_state['steps'].values())
+    healthy = warmup_state['ready'] and not degraded
+    return jsonify({
+        'ready': warmup_state['ready'],
+        'degraded': degraded,
+        'started_at': warmup_state['started_at'],
+        'finished_at': warmup_state['finished_at'],
+        'steps': warmup_state['steps'],
+        'canned_phrases': {text: text in canned_audio for text in CANNED_PHRASES},
+    }), 200 if healthy else 503
+
+@app.route('/api/voice-chat/canned', methods=['POST'])
+def voice_chat_canned():
+    """下发一条预渲染的固定回复，格式与 /api/voice-chat/stream 相同，同样支持续传"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        text = data.get('text', '')
+        
+        # 验证会话
+        if not session_id or session_id not in active_calls:
+            return jsonify({"error": "无效的会话ID"}), 400
+        if text not in CANNED_PHRASES:
+            return jsonify({"error": "未配置的固定回复"}), 404
+        
+        active_calls[session_id]['last_activity'] = time.time()
+        
+        buffer = ReplyBuffer(str(uuid.uuid4()), session_id)
+        with reply_buffers_lock:
+            reply_buffers[buffer.reply_id] = buffer
+        stream_canned_reply(buffer, text)
+        buffer.close()
+        
+        return Response(
+            stream_with_context(buffer.iter_events()),
+            content_type='text/event-stream',
+            headers={'X-Reply-Id': buffer.reply_id}
+        )
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
@@ -639,6 +1102,326 @@ def text_only_chat():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ---------------- 性能剖析（管理员） ----------------
+
+def _check_admin():
+    """校验管理员令牌，未配置 ADMIN_TOKEN 时一律拒绝"""
+    token = request.headers.get('X-Admin-Token', '')
+    # 按字节比较，非ASCII令牌不会让 compare_digest 抛出 TypeError
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def _collapse_stack(frame):
+    """将调用栈折叠为 flamegraph 使用的 'a;b;c' 格式（根在前）"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    parts.reverse()
+    return ';'.join(parts)
+
+def _finish_profile():
+    """结束剖析，调用方需持有 profiler_lock
+
+    只在锁内获取 tracemalloc 快照并返回，耗时的归类由调用方释放锁后
+    交给 _save_allocation_report 完成；未统计内存分配时返回 None。
+    """
+    if not profiler_state['active']:
+        return None
+    profiler_state['active'] = False
+    profiled_threads.clear()
+    snapshot = None
+    if profiler_state['track_allocations'] and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    return snapshot
+
+def _save_allocation_report(snapshot, generation):
+    """在锁外生成内存分配报告并保存，期间若已开始新一轮剖析则丢弃"""
+    global profile_allocation_report
+    if snapshot is None:
+        return
+    report = _allocation_report(snapshot)
+    with profiler_lock:
+        if profiler_state['generation'] == generation:
+            profile_allocation_report = report
+
+def _endpoint_line_ranges():
+    """视图函数所在的源码行范围：文件名 -> [(起始行, 结束行, 端点)]
+
+    嵌套的 generate() 生成器位于视图函数的行范围内，同样会归入该端点；
+    后台生成回复的 produce_stream_reply 归入 voice_chat_stream。
+    """
+    admin_endpoints = {rule.endpoint for rule in app.url_map.iter_rules() if rule.rule.startswith('/api/admin/')}
+    functions = [(endpoint, func) for endpoint, func in app.view_functions.items()
+                 if endpoint not in admin_endpoints]
+    functions.append(('voice_chat_stream', produce_stream_reply))
+    ranges = {}
+    for endpoint, func in functions:
+        func = inspect.unwrap(func)
+        try:
+            lines, start = inspect.getsourcelines(func)
+            filename = inspect.getsourcefile(func)
+        except (OSError, TypeError):
+            continue
+        ranges.setdefault(filename, []).append((start, start + len(lines) - 1, endpoint))
+    return ranges
+
+def _allocation_report(snapshot):
+    """按调用栈中的视图函数统计快照中仍被占用的内存，并给出分配热点"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    ranges = _endpoint_line_ranges()
+    frame_endpoints = {}  # (文件名, 行号) -> 端点，避免重复查找
+    
+    def frame_endpoint(frame):
+        key = (frame.filename, frame.lineno)
+        if key not in frame_endpoints:
+            frame_endpoints[key] = next(
+                (endpoint for start, end, endpoint in ranges.get(frame.filename, ())
+                 if start <= frame.lineno <= end),
+                None
+            )
+        return frame_endpoints[key]
+    
+    endpoints = {}
+    for trace in snapshot.traces:
+        endpoint = next(filter(None, map(frame_endpoint, trace.traceback)), None)
+        if endpoint is None:
+            continue
+        stats = endpoints.setdefault(endpoint, {'size': 0, 'count': 0, 'sites': {}})
+        stats['size'] += trace.size
+        stats['count'] += 1
+        # 分配热点取最内层的帧（traceback 从最外层排到最内层）
+        frame = trace.traceback[-1]
+        site = f"{frame.filename}:{frame.lineno}"
+        stats['sites'][site] = stats['sites'].get(site, 0) + trace.size
+    
+    for stats in endpoints.values():
+        top = sorted(stats['sites'].items(), key=lambda item: item[1], reverse=True)[:10]
+        stats['sites'] = [{'location': site, 'size': size} for site, size in top]
+    
+    top_sites = [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size': stat.size,
+            'count': stat.count,
+        }
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]
+    ]
+    return {'endpoints': endpoints, 'top_sites': top_sites}
+
+def _profile_sampler(generation):
+    """采样线程：定时抓取各线程调用栈并累计到 profile_stacks"""
+    own_id = threading.get_ident()
+    thread_names = {}
+    while True:
+        with profiler_lock:
+            # 剖析已结束或已开启新一轮剖析时退出
+            if not profiler_state['active'] or profiler_state['generation'] != generation:
+                return
+            if time.time() >= profiler_state['ends_at']:
+                print("性能剖析已到时结束")
+                snapshot = _finish_profile()
+                break
+            interval = profiler_state['interval']
+            only_requests = profiler_state['mode'] == 'requests'
+            targets = dict(profiled_threads)
+        
+        frames = sys._current_frames()
+        if len(thread_names) != threading.active_count():
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+        
+        collected = []
+        for thread_id, frame in frames.items():
+            if thread_id == own_id:
+                continue
+            endpoint = targets.get(thread_id)
+            if only_requests and endpoint is None:
+                continue
+            # 以端点（或线程名）作为根帧，便于按接口区分火焰图
+            root = endpoint or thread_names.get(thread_id, f"thread-{thread_id}")
+            collected.append(f"{root};{_collapse_stack(frame)}")
+        del frames
+        
+        with profiler_lock:
+            if profiler_state['generation'] != generation:
+                return
+            for stack in collected:
+                profile_stacks[stack] = profile_stacks.get(stack, 0) + 1
+            profiler_state['samples'] += 1
+        
+        time.sleep(interval)
+    
+    # 到时结束：释放锁后再生成内存分配报告，避免阻塞正在被剖析的请求
+    _save_allocation_report(snapshot, generation)
+
+@app.before_request
+def _profile_request_start():
+    # 剖析未开启时只做一次字典读取，开销可忽略
+    if not profiler_state['active']:
+        return
+    if profiler_state['mode'] == 'requests' and random.uniform(0, 100) >= profiler_state['sample_rate']:
+        return
+    endpoint = request.endpoint or request.path
+    if request.path.startswith('/api/admin/'):
+        return
+    g.profile_endpoint = endpoint
+    with profiler_lock:
+        profiled_threads[threading.get_ident()] = endpoint
+        profile_request_counts[endpoint] = profile_request_counts.get(endpoint, 0) + 1
+
+@app.teardown_request
+def _profile_request_end(exc):
+    # 流式响应在生成器结束后才会触发 teardown，因此采样覆盖整个 SSE 回复
+    if g.pop('profile_endpoint', None) is None:
+        return
+    with profiler_lock:
+        profiled_threads.pop(threading.get_ident(), None)
+
+@app.route('/api/admin/profile/start', methods=['POST'])
+def start_profile():
+    """开启采样剖析：持续 duration 秒，或只采样 sample_rate% 的请求"""
+    if not _check_admin():
+        return jsonify({"error": "没有权限"}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        duration = float(data.get('duration', 30))
+        interval_ms = float(data.get('interval_ms', 5))
+        sample_rate = data.get('sample_rate')
+        sample_rate = None if sample_rate is None else float(sample_rate)
+    except (TypeError, ValueError):
+        return jsonify({"error": "参数格式错误"}), 400
+    
+    if not 0 < duration <= PROFILE_MAX_DURATION:
+        return jsonify({"error": f"duration 必须在 0 到 {PROFILE_MAX_DURATION} 秒之间"}), 400
+    if not 1 <= interval_ms <= 1000:
+        return jsonify({"error": "interval_ms 必须在 1 到 1000 之间"}), 400
+    if sample_rate is not None and not 0 < sample_rate <= 100:
+        return jsonify({"error": "sample_rate 必须在 0 到 100 之间"}), 400
+    
+    global profile_allocation_report, profile_sampler_thread
+    with profiler_lock:
+        if profiler_state['active']:
+            return jsonify({"error": "已有剖析正在进行"}), 409
+        previous_sampler = profile_sampler_thread
+    
+    # 等待上一轮的采样线程退出（最多一个采样间隔），避免两个线程同时采样
+    if previous_sampler is not None:
+        previous_sampler.join()
+    
+    with profiler_lock:
+        if profiler_state['active']:
+            return jsonify({"error": "已有剖析正在进行"}), 409
+        
+        track_allocations = bool(data.get('track_allocations', False))
+        # 由其他工具开启的 tracemalloc 不归我们管理
+        if track_allocations and tracemalloc.is_tracing():
+            return jsonify({"error": "tracemalloc 已在运行，无法开启内存分配统计"}), 409
+        
+        profile_stacks.clear()
+        profile_request_counts.clear()
+        profile_allocation_report = {}
+        profiled_threads.clear()
+        now = time.time()
+        profiler_state.update({
+            'mode': 'duration' if sample_rate is None else 'requests',
+            'started_at': now,
+            'ends_at': now + duration,
+            'interval': interval_ms / 1000.0,
+            'sample_rate': 100.0 if sample_rate is None else sample_rate,
+            'track_allocations': track_allocations,
+            'samples': 0,
+            'generation': profiler_state['generation'] + 1,
+        })
+        if track_allocations:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        profiler_state['active'] = True
+        
+        profile_sampler_thread = threading.Thread(
+            target=_profile_sampler,
+            args=(profiler_state['generation'],),
+            name='profile-sampler',
+            daemon=True
+        )
+        profile_sampler_thread.start()
+    print(f"性能剖析已开始: 模式={profiler_state['mode']}, 时长={duration}秒")
+    
+    return jsonify({'status': 'started', 'profile': _profile_status()})
+
+@app.route('/api/admin/profile/stop', methods=['POST'])
+def stop_profile():
+    """提前结束当前剖析"""
+    if not _check_admin():
+        return jsonify({"error": "没有权限"}), 403
+    with profiler_lock:
+        snapshot = _finish_profile()
+        generation = profiler_state['generation']
+    _save_allocation_report(snapshot, generation)
+    return jsonify({'status': 'stopped', 'profile': _profile_status()})
+
+def _profile_status():
+    with profiler_lock:
+        return {
+            'active': profiler_state['active'],
+            'mode': profiler_state['mode'],
+            'started_at': profiler_state['started_at'],
+            'ends_at': profiler_state['ends_at'],
+            'interval_ms': profiler_state['interval'] * 1000,
+            'sample_rate': profiler_state['sample_rate'],
+            'track_allocations': profiler_state['track_allocations'],
+            'samples': profiler_state['samples'],
+            'unique_stacks': len(profile_stacks),
+        }
+
+@app.route('/api/admin/profile/status', methods=['GET'])
+def profile_status():
+    """查询剖析状态"""
+    if not _check_admin():
+        return jsonify({"error": "没有权限"}), 403
+    return jsonify(_profile_status())
+
+@app.route('/api/admin/profile/collapsed', methods=['GET'])
+def profile_collapsed():
+    """下载折叠栈结果，可直接交给 flamegraph.pl 或 speedscope"""
+    if not _check_admin():
+        return jsonify({"error": "没有权限"}), 403
+    with profiler_lock:
+        lines = [f"{stack} {count}" for stack, count in
+                 sorted(profile_stacks.items(), key=lambda item: item[1], reverse=True)]
+        started_at = profiler_state['started_at'] or time.time()
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at))}.collapsed"
+    return Response(
+        '\n'.join(lines) + ('\n' if lines else ''),
+        content_type='text/plain; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@app.route('/api/admin/profile/allocations', methods=['GET'])
+def profile_allocations_report():
+    """内存分配报告
+
+    endpoints 按分配时调用栈中的视图函数归类，统计的是剖析期间分配且仍未释放的内存，
+    因此并发请求和其他线程的分配不会被算到别的端点上。
+    """
+    if not _check_admin():
+        return jsonify({"error": "没有权限"}), 403
+    snapshot = None
+    with profiler_lock:
+        # 锁内只取快照，归类统计在释放锁后进行
+        if profiler_state['active'] and profiler_state['track_allocations'] and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+        else:
+            report = dict(profile_allocation_report)
+        request_counts = dict(profile_request_counts)
+    if snapshot is not None:
+        report = _allocation_report(snapshot)
+    report['requests'] = request_counts
+    return jsonify(report)
+
 if __name__ == '__main__':
     # 设置HTTPS参数
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)